@@ -6,11 +6,12 @@ import socket
 import threading
 import select
 import os
+import collections
 
 import users
 
 
-class MobilePeerState(enum.Enum):
+class MobilePeerState(enum.IntEnum):
     CONNECTED = enum.auto()
     CALLING = enum.auto()
     WAITING = enum.auto()
@@ -18,45 +19,100 @@ class MobilePeerState(enum.Enum):
     LINKED = enum.auto()
 
 
+class MobilePeerEvent(enum.IntEnum):
+    CALL_READY = enum.auto()
+    WAIT = enum.auto()
+    WAIT_READY = enum.auto()
+    WAIT_STOP = enum.auto()
+
+
 class MobilePeer:
+    __slots__ = ("_pair", "_user", "_number_bytes", "_state", "_lock",
+                 "_signals", "_signal_poll", "signal_fd", "sock")
+
     _pair: "typing.Optional[MobilePeer]"
     _user: users.MobileUser
+    _number_bytes: bytes
     _state: MobilePeerState
     _lock: threading.Lock
+    _signals: collections.deque[int]
+    _signal_poll: select.poll
+    signal_fd: int
     sock: typing.Optional[socket.socket]
 
-    def __init__(self, user: users.MobileUser):
+    # Signal value used by wake(), never a valid MobilePeerState
+    SIGNAL_WAKE = 0
+
+    # Valid state transitions, other events are rejected in any given state
+    _TRANSITIONS: dict[tuple[MobilePeerState, MobilePeerEvent],
+                       MobilePeerState] = {
+        (MobilePeerState.CONNECTED, MobilePeerEvent.CALL_READY):
+            MobilePeerState.LINKING,
+        (MobilePeerState.CONNECTED, MobilePeerEvent.WAIT):
+            MobilePeerState.WAITING,
+        (MobilePeerState.WAITING, MobilePeerEvent.WAIT):
+            MobilePeerState.WAITING,
+        (MobilePeerState.WAITING, MobilePeerEvent.WAIT_READY):
+            MobilePeerState.LINKING,
+        (MobilePeerState.CONNECTED, MobilePeerEvent.WAIT_STOP):
+            MobilePeerState.CONNECTED,
+        (MobilePeerState.WAITING, MobilePeerEvent.WAIT_STOP):
+            MobilePeerState.CONNECTED,
+    }
+
+    def __init__(self, user: users.MobileUser, lock: threading.Lock):
         self._user = user
+        self._number_bytes = user.number.encode()
         self._pair = None
         self._state = MobilePeerState.CONNECTED
-        self._lock = threading.Lock()
-        self.rpipe, self.wpipe = os.pipe()
+        self._lock = lock
         self.sock = None
 
+        # Signals from the pair are queued in _signals, and counted by the
+        #  eventfd, which may be polled alongside the client's socket.
+        self._signals = collections.deque()
+        self.signal_fd = os.eventfd(0, os.EFD_SEMAPHORE | os.EFD_CLOEXEC)
+        self._signal_poll = select.poll()
+        self._signal_poll.register(self.signal_fd, select.POLLIN)
+
     def __del__(self):
-        os.close(self.rpipe)
-        os.close(self.wpipe)
+        os.close(self.signal_fd)
 
     def close(self):
         # Allows proper cleaning up of the object...
         self._pair = None
 
-    def _pipe_recv(self, delay: int = 0) -> bytes:
-        # Check if any data is available at all
-        p = select.poll()
-        p.register(self.rpipe, select.POLLIN)
-        if not p.poll(delay):
-            return b''
-
-        # Read the data
-        return os.read(self.rpipe, 1)
-
-    def _pipe_send(self, value: int) -> None:
-        os.write(self._pair.wpipe, bytes([value]))
+    def _signal_recv(self, delay: int = 0) -> bytes:
+        # Check if any signal is available at all
+        while self._signal_poll.poll(delay):
+            # Consume a single signal, wakeups don't carry any information
+            os.eventfd_read(self.signal_fd)
+            value = self._signals.popleft()
+            if value != self.SIGNAL_WAKE:
+                return bytes([value])
+        return b''
+
+    def _signal_send(self, value: int) -> None:
+        self._pair._signals.append(value)
+        os.eventfd_write(self._pair.signal_fd, 1)
+
+    def wake(self) -> None:
+        # Interrupt anything polling signal_fd, without sending a signal
+        self._signals.append(self.SIGNAL_WAKE)
+        os.eventfd_write(self.signal_fd, 1)
+
+    def clear_wake(self) -> None:
+        # Consume pending wakeups, leaving any actual signals queued
+        while self._signals and self._signals[0] == self.SIGNAL_WAKE:
+            os.eventfd_read(self.signal_fd)
+            self._signals.popleft()
 
     def get_number(self) -> str:
         return self._user.number
 
+    def get_number_bytes(self) -> bytes:
+        return self._number_bytes
+
     def get_token(self) -> bytes:
         return self._user.token
 
@@ -69,6 +125,25 @@ class MobilePeer:
     def get_pair_number(self) -> str:
         return self._pair.get_number()
 
+    def get_pair_number_bytes(self) -> bytes:
+        return self._pair.get_number_bytes()
+
+    def _transition(self, event: MobilePeerEvent) -> bool:
+        state = self._TRANSITIONS.get((self._state, event))
+        if state is None:
+            return False
+        self._state = state
+        return True
+
+    def _check_callable(self) -> int:
+        if self._state == MobilePeerState.CONNECTED:
+            return 0
+        if self._state != MobilePeerState.WAITING:
+            return 2  # busy
+        if self._pair is not None:
+            return 2  # busy
+        return 1
+
     def call(self, pair: "typing.Optional[MobilePeer]") -> int:
         # We've already connected, move along
         if self._pair is not None:
@@ -80,62 +155,56 @@ class MobilePeer:
         if pair is None:
             return 0
 
+        # Unlocked fast path, most calls bail out here
+        res = pair._check_callable()
+        if res != 1:
+            return res
+
         # Lock to make sure no two threads can call the same number at once
         with pair._lock:
-            if pair._state == MobilePeerState.CONNECTED:
-                return 0
-            if pair._state != MobilePeerState.WAITING:
-                return 2  # busy
-            if pair._pair is not None:
-                return 2  # busy
+            res = pair._check_callable()
+            if res != 1:
+                return res
 
             # Update states
             # Once past this barrier, the only way to back away is
             #  to disconnect from the peer.
             self.set_pair(pair)
             pair.set_pair(self)
-            self._pipe_send(MobilePeerState.WAITING.value)
+            self._signal_send(MobilePeerState.WAITING)
             return 1
 
     def call_ready(self) -> None:
         # Signal readiness to start relaying
-        if self._state == MobilePeerState.CONNECTED:
-            self._state = MobilePeerState.LINKING
-            self._pipe_send(MobilePeerState.LINKING.value)
+        if self._transition(MobilePeerEvent.CALL_READY):
+            self._signal_send(MobilePeerState.LINKING)
 
     def wait(self, delay: int = 0) -> int:
         # If we've received the call, move on
         if self._pair is not None:
-            b = self._pipe_recv(delay)
+            b = self._signal_recv(delay)
             if not b or len(b) < 1:
                 return 2
-            if b[0] != MobilePeerState.WAITING.value:
+            if b[0] != MobilePeerState.WAITING:
                 return 2
             return 1
 
-        if self._state == MobilePeerState.CONNECTED:
-            self._state = MobilePeerState.WAITING
-        if self._state != MobilePeerState.WAITING:
+        self.clear_wake()
+        if not self._transition(MobilePeerEvent.WAIT):
             return 2
         return 0
 
     def wait_ready(self) -> None:
         # Signal readiness to start relaying
-        if self._state == MobilePeerState.WAITING:
-            self._state = MobilePeerState.LINKING
-            self._pipe_send(MobilePeerState.LINKING.value)
+        if self._transition(MobilePeerEvent.WAIT_READY):
+            self._signal_send(MobilePeerState.LINKING)
 
     def wait_stop(self) -> bool:
         # Lock to make sure call() isn't about to read and modify our state
         with self._lock:
             if self._pair is not None:
                 return False
-            if self._state == MobilePeerState.CONNECTED:
-                return True
-            if self._state == MobilePeerState.WAITING:
-                self._state = MobilePeerState.CONNECTED
-                return True
-            return False
+            return self._transition(MobilePeerEvent.WAIT_STOP)
 
     def accept(self, delay: int = 0) -> int:
         # If we've linked, check if the pair is ready
@@ -146,10 +215,10 @@ class MobilePeer:
         if self._state != MobilePeerState.LINKING:
             return 2
 
-        b = self._pipe_recv(delay)
+        b = self._signal_recv(delay)
         if not b or len(b) < 1:
             return 0
-        if b[0] != MobilePeerState.LINKING.value:
+        if b[0] != MobilePeerState.LINKING:
             return 2
         if self._pair._state not in (MobilePeerState.LINKING,
                                      MobilePeerState.LINKED):
@@ -160,41 +229,81 @@ class MobilePeer:
 
 class MobilePeers:
     _users: users.MobileUserDatabase
-    _connected: dict[str, MobilePeer]
-    _connected_lock: threading.Lock
+    _connected: dict[bytes, MobilePeer]
+    _connected_locks: list[threading.Lock]
+    _dialing: dict[bytes, set[MobilePeer]]
+
+    # Number of lock stripes guarding _connected, must be a power of two
+    LOCK_STRIPES = 64
 
     def __init__(self, users_db: users.MobileUserDatabase):
         self._users = users_db
         self._connected = {}
-        self._connected_lock = threading.Lock()
+        self._connected_locks = [threading.Lock()
+                                 for x in range(self.LOCK_STRIPES)]
+        self._dialing = {}
+
+    def _bucket(self, number: bytes) -> threading.Lock:
+        return self._connected_locks[hash(number) & (self.LOCK_STRIPES - 1)]
+
+    def _insert(self, user: users.MobileUser) -> typing.Optional[MobilePeer]:
+        # Only peers sharing a lock stripe contend with each other here
+        # Peers also use their stripe to guard their own state transitions
+        number = user.number.encode()
+        lock = self._bucket(number)
+        peer = MobilePeer(user, lock)
+        with lock:
+            if self._connected.setdefault(number, peer) is not peer:
+                return None
+            return peer
 
     def connect(self, token: bytes = b"") -> typing.Optional[MobilePeer]:
         with self._users:
-            user = None
-            if token:
-                user = self._users.lookup_token(token)
+            if not token:
+                # Nobody else knows the new user's token yet, so there's no
+                #  need to lock anything besides the database write itself.
+                # Its last_seen was just set on insert, so skip update().
+                user = self._users.new()
                 if user is None:
                     return None
+                return self._insert(user)
 
-            # Lock includes user creation to avoid having a different thread
-            #  log into a recently created user.
-            with self._connected_lock:
-                if user is None:
-                    user = self._users.new()
-                    if user is None:
-                        return None
-
-                if user.number in self._connected:
-                    return None
+            user = self._users.lookup_token(token)
+            if user is None:
+                return None
 
+            # Cheap unsynchronized probe, _insert() checks again
+            if user.number.encode() in self._connected:
+                return None
+            peer = self._insert(user)
+            if peer is not None:
                 self._users.update(user)
-                peer = MobilePeer(user)
-                self._connected[peer.get_number()] = peer
             return peer
 
     def disconnect(self, user: MobilePeer) -> None:
-        peer = self._connected.pop(user.get_number())
+        number = user.get_number_bytes()
+        with self._bucket(number):
+            peer = self._connected.pop(number)
         peer.close()
 
-    def dial(self, number: str) -> typing.Optional[MobilePeer]:
+    def dial(self, number: bytes) -> typing.Optional[MobilePeer]:
         return self._connected.get(number)
+
+    def dial_watch(self, number: bytes, caller: MobilePeer) -> None:
+        # Have caller woken up whenever number may be called
+        with self._bucket(number):
+            self._dialing.setdefault(number, set()).add(caller)
+
+    def dial_unwatch(self, number: bytes, caller: MobilePeer) -> None:
+        with self._bucket(number):
+            callers = self._dialing[number]
+            callers.discard(caller)
+            if not callers:
+                del self._dialing[number]
+
+    def announce(self, user: MobilePeer) -> None:
+        # Wake up anyone trying to call this peer
+        number = user.get_number_bytes()
+        with self._bucket(number):
+            for caller in self._dialing.get(number, ()):
+                caller.wake()
@@ -3,8 +3,12 @@
 
 import typing
 import enum
+import os
 import time
 import select
+import socket
+import struct
+import threading
 import socketserver
 
 import users
@@ -13,6 +17,13 @@ import peers
 PROTOCOL_VERSION = 0
 handshake_magic = bytes([PROTOCOL_VERSION]) + b"MOBILE"
 
+# Maximum amount of data moved between relayed sockets at once
+RELAY_CHUNK_SIZE = 64 * 1024
+
+# Amount of data read at once while parsing commands
+# Must fit the largest field, which is a CALL number of up to 255 bytes.
+RECV_BUFFER_SIZE = 256
+
 
 class MobileRelayCommand(enum.IntEnum):
     CALL = 0
@@ -32,9 +43,24 @@ class MobileRelayWaitResult(enum.IntEnum):
     INTERNAL = enum.auto()
 
 
+# Constant parts of every reply, built once, and formats of the others
+handshake_header = handshake_magic + b"\x00"
+handshake_header_new = handshake_magic + b"\x01"
+call_header = bytes([PROTOCOL_VERSION, MobileRelayCommand.CALL])
+call_replies = [call_header + bytes([x]) for x in MobileRelayCallResult]
+wait_header = struct.Struct("BBBB")
+get_number_header = struct.Struct("BBB")
+
+
 class MobileRelay(socketserver.BaseRequestHandler):
     user_new: bool
     user: typing.Optional[peers.MobilePeer]
+    poller: select.epoll
+    rxbuf: bytearray
+    rxview: memoryview
+    rxstart: int
+    rxend: int
+    request_fd: int
     users: users.MobileUserDatabase
     peers: peers.MobilePeers
 
@@ -43,26 +69,73 @@ class MobileRelay(socketserver.BaseRequestHandler):
         self.peers = g_peers
         self.user = None
         self.user_new = False
+        self.rxbuf = bytearray(RECV_BUFFER_SIZE)
+        self.rxview = memoryview(self.rxbuf)
+        self.rxstart = 0
+        self.rxend = 0
+        self.request_fd = self.request.fileno()
+
+        # Relayed frames are small and latency sensitive, don't delay them
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.request.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        # Reused by every command, the peer's signal fd is added on login
+        self.poller = select.epoll()
+        self.poller.register(self.request, select.EPOLLIN | select.EPOLLPRI)
 
     def finish(self) -> None:
+        self.poller.close()
         if self.user:
             self.peers.disconnect(self.user)
 
     def log(self, *args) -> None:
         print(self.client_address, *args)
 
+    def send_buffers(self, *buffers: bytes) -> None:
+        # Gather all buffers into a single syscall, finish any short write
+        sent = self.request.sendmsg(buffers)
+        if sent < sum(len(x) for x in buffers):
+            self.request.sendall(b"".join(buffers)[sent:])
+
+    def recv_exact(self, size: int) -> typing.Optional[bytes]:
+        # Read exactly size bytes, None if the client disconnected early
+        # Commands are small and usually arrive together, so read ahead.
+        if self.rxend - self.rxstart < size:
+            # Move any leftover data to the start of the buffer
+            left = self.rxend - self.rxstart
+            self.rxview[:left] = self.rxview[self.rxstart:self.rxend]
+            self.rxstart = 0
+            self.rxend = left
+        while self.rxend - self.rxstart < size:
+            res = self.request.recv_into(self.rxview[self.rxend:])
+            if not res:
+                return None
+            self.rxend += res
+        res = bytes(self.rxview[self.rxstart:self.rxstart + size])
+        self.rxstart += size
+        return res
+
+    def poll_client(self, timeout: typing.Optional[float] = None) -> bool:
+        # Wait for any event, True if it came from the client
+        if self.rxstart != self.rxend:
+            return True
+        events = self.poller.poll(timeout)
+        return any(fd == self.request_fd for fd, _ in events)
+
     def recv_handshake(self) -> bool:
-        handshake = self.request.recv(len(handshake_magic))
-        if handshake != handshake_magic:
+        handshake = self.recv_exact(len(handshake_magic) + 1)
+        if handshake is None or handshake[:-1] != handshake_magic:
             return False
 
-        has_token, = self.request.recv(1)
+        has_token = handshake[-1]
         self.user_new = False
         if has_token == 0:
             user = self.peers.connect()
             self.user_new = True
         elif has_token == 1:
-            token = self.request.recv(16)
+            token = self.recv_exact(16)
+            if token is None:
+                return False
             user = self.peers.connect(token)
         else:
             return False
@@ -74,157 +147,168 @@ class MobileRelay(socketserver.BaseRequestHandler):
         return True
 
     def send_handshake(self) -> None:
-        buffer = bytearray(handshake_magic)
-        buffer.append(self.user_new)
         if self.user_new:
-            buffer += self.user.get_token()
-        self.request.send(buffer)
+            self.send_buffers(handshake_header_new, self.user.get_token())
+        else:
+            self.request.sendall(handshake_header)
 
-    def recv_call(self) -> typing.Optional[str]:
-        number_len, = self.request.recv(1)
-        if not number_len:
+    def recv_call(self) -> typing.Optional[bytes]:
+        number_len = self.recv_exact(1)
+        if not number_len or not number_len[0]:
             return None
-        number = self.request.recv(number_len).decode()
-        return number
+        return self.recv_exact(number_len[0])
 
     def send_call(self, result: MobileRelayCallResult) -> None:
-        buffer = bytearray([PROTOCOL_VERSION, MobileRelayCommand.CALL])
-        buffer.append(result)
-        self.request.send(buffer)
+        self.request.sendall(call_replies[result])
 
     def handle_call(self) -> bool:
         number = self.recv_call()
         if number is None:
             return False
-        self.log("Command: CALL %s" % number)
-
-        poller = select.poll()
-        poller.register(self.request, select.POLLIN | select.POLLPRI)
+        caller = self.user
+        assert caller is not None
+        self.log("Command: CALL %s" % number.decode(errors="replace"))
 
         # Find an available peer with the correct phone number
-        user = None
-        timer = time.time()
-        while True:
-            # Get peer attached to number
-            if user is None:
+        # Whoever has the number wakes us up once it starts waiting, so
+        #  there's no need to retry until either that or a timeout happens.
+        self.peers.dial_watch(number, caller)
+        try:
+            deadline = time.monotonic() + 30
+            while True:
+                # Get peer attached to number
                 user = self.peers.dial(number)
 
-            # Try to call the peer
-            if user is not None:
-                res = self.user.call(user)
-                if res == 1:
-                    break
-                elif res == 2:
-                    self.send_call(MobileRelayCallResult.BUSY)
-                    return False
-                elif res == 3:
-                    self.send_call(MobileRelayCallResult.INTERNAL)
-                    raise ConnectionResetError
-                elif res != 0:
-                    self.send_call(MobileRelayCallResult.INTERNAL)
-                    raise ConnectionResetError
-
-            # Time out after a while
-            if (time.time() - timer) >= 30:
+                # Try to call the peer
                 if user is not None:
-                    self.send_call(MobileRelayCallResult.BUSY)
-                else:
-                    self.send_call(MobileRelayCallResult.UNAVAILABLE)
-                return False
+                    res = caller.call(user)
+                    if res == 1:
+                        break
+                    elif res == 2:
+                        self.send_call(MobileRelayCallResult.BUSY)
+                        return False
+                    elif res == 3:
+                        self.send_call(MobileRelayCallResult.INTERNAL)
+                        raise ConnectionResetError
+                    elif res != 0:
+                        self.send_call(MobileRelayCallResult.INTERNAL)
+                        raise ConnectionResetError
+
+                # Time out after a while
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if user is not None:
+                        self.send_call(MobileRelayCallResult.BUSY)
+                    else:
+                        self.send_call(MobileRelayCallResult.UNAVAILABLE)
+                    return False
 
-            # If the client sends anything, we can still back out
-            if poller.poll(100):
-                return False
+                # If the client sends anything, we can still back out
+                if self.poll_client(remaining):
+                    return False
+                caller.clear_wake()
+        finally:
+            self.peers.dial_unwatch(number, caller)
         self.send_call(MobileRelayCallResult.ACCEPTED)
-        self.user.call_ready()
+        caller.call_ready()
         return True
 
     def send_wait(self, result: MobileRelayWaitResult,
-                  number: str = "") -> None:
-        encnum = number.encode()
-        buffer = bytearray([PROTOCOL_VERSION, MobileRelayCommand.WAIT])
-        buffer.append(result)
-        buffer.append(len(encnum))
-        buffer += encnum
-        self.request.send(buffer)
+                  number: bytes = b"") -> None:
+        header = wait_header.pack(PROTOCOL_VERSION, MobileRelayCommand.WAIT,
+                                  result, len(number))
+        self.send_buffers(header, number)
 
     def handle_wait(self) -> bool:
         self.log("Command: WAIT")
-
-        poller = select.poll()
-        poller.register(self.user.sock, select.POLLIN)
-        poller.register(self.user.rpipe, select.POLLIN)
+        user = self.user
+        assert user is not None
 
         # Set self into waiting state, break out when called
+        res = user.wait()
+        if res == 0:
+            self.peers.announce(user)
         while True:
-            res = self.user.wait()
             if res == 1:
                 break
             elif res != 0:
                 self.send_wait(MobileRelayWaitResult.INTERNAL)
                 raise ConnectionResetError
 
-            # Wait for any event
-            events = poller.poll()
-
             # Break out if any data or error is available in the socket
-            if any(fd == self.user.sock.fileno() for fd, _ in events):
-                if not self.user.wait_stop():
+            if self.poll_client():
+                if not user.wait_stop():
                     raise ConnectionResetError
                 return False
+            res = user.wait()
         self.send_wait(MobileRelayWaitResult.ACCEPTED,
-                       self.user.get_pair_number())
-        self.user.wait_ready()
+                       user.get_pair_number_bytes())
+        user.wait_ready()
         return True
 
     def send_get_number(self) -> None:
-        number = self.user.get_number().encode()
-        buffer = bytearray([PROTOCOL_VERSION, MobileRelayCommand.GET_NUMBER])
-        buffer.append(len(number))
-        buffer += number
-        self.request.send(buffer)
+        number = self.user.get_number_bytes()
+        header = get_number_header.pack(PROTOCOL_VERSION,
+                                        MobileRelayCommand.GET_NUMBER,
+                                        len(number))
+        self.send_buffers(header, number)
 
-    def handle_get_number(self) -> None:
+    def handle_get_number(self) -> bool:
         self.log("Command: GET_NUMBER")
         self.send_get_number()
+        return False
 
     def handle_relay(self) -> None:
         # Wait until peer is ready to receive data
-        poller = select.poll()
-        poller.register(self.user.rpipe, select.POLLIN)
-        if not poller.poll(1000):
-            raise ConnectionResetError
-        if self.user.accept() != 1:
+        if self.user.accept(1000) != 1:
             raise ConnectionResetError
+        self.poller.unregister(self.user.signal_fd)
 
         self.log("Starting relay")
         # TODO: Fork out a process, close sockets in parent
         #       This helps avoid the GIL and would reduce issues
         #        with many simultaneous clients (assuming no directed abuse).
+        # Data is spliced through a pipe, never being copied into userspace
+        rpipe, wpipe = os.pipe()
+        pair = -1
         try:
-            mine = self.request
-            pair = self.user.get_pair_socket()
-
-            poller = select.poll()
-            poller.register(mine, select.POLLIN | select.POLLPRI)
-            poller.register(pair, select.POLLRDHUP)
+            mine = self.request_fd
+            # The pair's handler may close its socket at any time, after
+            #  which its fd number may be reused by another client. Hold on
+            #  to our own duplicate, so the number stays ours.
+            pair = os.dup(self.user.get_pair_socket().fileno())
+
+            # Pass on anything that was read ahead along with the command
+            if self.rxstart != self.rxend:
+                self.user.get_pair_socket().sendall(
+                    self.rxview[self.rxstart:self.rxend])
+                self.rxstart = self.rxend = 0
+
+            self.poller.register(pair, select.EPOLLRDHUP)
             while True:
-                events = poller.poll()
+                events = self.poller.poll()
 
                 for fd, event in events:
-                    if fd == mine.fileno():
-                        data = mine.recv(1024)
-                        if not data:
+                    if fd == mine:
+                        size = os.splice(mine, wpipe, RELAY_CHUNK_SIZE,
+                                         flags=os.SPLICE_F_MOVE)
+                        if not size:
                             return
-                        pair.send(data)
-                    elif fd == pair.fileno() and event & select.POLLRDHUP:
+                        while size:
+                            size -= os.splice(rpipe, pair, size,
+                                              flags=os.SPLICE_F_MOVE)
+                    elif fd == pair and event & select.EPOLLRDHUP:
                         return
-        except ConnectionResetError:
+        except OSError:
             # There's a billion normal circumstances in which a client can
-            #  cause this error instead of returning an empty buffer.
+            #  cause an error instead of returning an empty buffer.
             # We don't care about them at this point.
             pass
         finally:
+            if pair != -1:
+                os.close(pair)
+            os.close(rpipe)
+            os.close(wpipe)
             self.log("Quit: Disconnect")
 
     def handle(self) -> None:
@@ -234,12 +318,13 @@ class MobileRelay(socketserver.BaseRequestHandler):
             self.log("Quit: Login failed")
             return
         self.send_handshake()
+        self.poller.register(self.user.signal_fd, select.EPOLLIN)
         self.log("Logged in as %s" % self.user.get_number(),
                  "(new user)" if self.user_new else "")
 
         while True:
-            data = self.request.recv(2)
-            if len(data) < 2:
+            data = self.recv_exact(2)
+            if data is None:
                 self.log("Quit: Disconnect")
                 return
 
@@ -248,21 +333,53 @@ class MobileRelay(socketserver.BaseRequestHandler):
                 self.log("Quit: Invalid command")
                 return
 
-            if command == MobileRelayCommand.CALL:
-                if self.handle_call():
-                    return self.handle_relay()
-            elif command == MobileRelayCommand.WAIT:
-                if self.handle_wait():
-                    return self.handle_relay()
-            elif command == MobileRelayCommand.GET_NUMBER:
-                self.handle_get_number()
-            else:
+            handler = self.COMMANDS.get(command)
+            if handler is None:
                 self.log("Quit: Invalid command")
                 return
 
+            # Handlers return True once the client is ready to be relayed
+            if handler(self):
+                return self.handle_relay()
+
+    COMMANDS: dict[int, typing.Callable[["MobileRelay"], bool]] = {
+        MobileRelayCommand.CALL: handle_call,
+        MobileRelayCommand.WAIT: handle_wait,
+        MobileRelayCommand.GET_NUMBER: handle_get_number,
+    }
+
 
 class Server(socketserver.ThreadingTCPServer):
     allow_reuse_address = True
+    daemon_threads = True
+    block_on_close = False
+
+    # Connections beyond this are refused instead of getting a thread
+    max_clients = 1024
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._clients = threading.BoundedSemaphore(self.max_clients)
+
+    def verify_request(self, request, client_address) -> bool:
+        if not self._clients.acquire(blocking=False):
+            print(client_address, "Refused: Too many clients")
+            return False
+        return True
+
+    def process_request(self, request, client_address) -> None:
+        # The thread gives the slot back once done, unless it never started
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._clients.release()
+            raise
+
+    def process_request_thread(self, request, client_address) -> None:
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._clients.release()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
+import os
 import time
 import typing
 import unittest
 import socket
+import tempfile
+import users
 from server import PROTOCOL_VERSION, handshake_magic, MobileRelayCommand, \
     MobileRelayCallResult, MobileRelayWaitResult
 
@@ -163,5 +166,64 @@ class Tests(unittest.TestCase):
         c2.recv_call()
         c2.close()
 
+
+class UserTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        config = os.path.join(self.tmpdir.name, "config.ini")
+        with open(config, "w") as f:
+            f.write("[sqlite]\ndatabase = %s\n" %
+                    os.path.join(self.tmpdir.name, "users.db"))
+        self.users = users.MobileUserDatabase(config)
+
+    def tearDown(self):
+        self.users.shutdown()
+        self.tmpdir.cleanup()
+
+    def test_number_range(self):
+        numbers = [self.users._generate_number() for x in range(100000)]
+        for number in numbers:
+            self.assertEqual(len(number), 10)
+            self.assertTrue(number.isdigit())
+            self.assertTrue("0110000000" <= number <= "0999999999")
+
+        # Both ends of the range must be handed out
+        self.assertTrue(any(x.startswith("01") for x in numbers))
+        self.assertTrue(any(x.startswith("09") for x in numbers))
+
+    def test_new_batch(self):
+        created = self.users.new_batch(50)
+        self.assertEqual(len(created), 50)
+        self.assertEqual(len({x.token for x in created}), 50)
+        self.assertEqual(len({x.number for x in created}), 50)
+        for user in created:
+            self.assertEqual(self.users.lookup_token(user.token), user)
+
+    def test_new_batch_retry(self):
+        # Take a number behind the in-memory set's back, like another
+        #  server sharing the database would, then have it generated.
+        with self.users:
+            self.users._db.insert_user(b"\xff" * 16, "0123456789")
+            self.users._db.commit()
+
+        generate = self.users._generate_users
+        attempts = []
+
+        def generate_users(count):
+            res = generate(count)
+            if not attempts:
+                res[0] = users.MobileUser(res[0].token, "0123456789")
+            attempts.append(res)
+            return res
+        self.users._generate_users = generate_users
+
+        created = self.users.new_batch(5)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(len(created), 5)
+        self.assertNotIn("0123456789", [x.number for x in created])
+        for user in created:
+            self.assertEqual(self.users.lookup_token(user.token), user)
+        self.assertIsNone(self.users.lookup_token(attempts[0][1].token))
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
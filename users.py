@@ -1,10 +1,11 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import os
 import typing
-import secrets
+import atexit
+import operator
 import threading
 import dataclasses
-import contextlib
 import configparser
 
 import sqlite3
@@ -14,19 +15,39 @@ except ImportError as e:
     MySQLdb = e
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class MobileUser:
     token: bytes
     number: str
 
 
-class DatabaseSQLBase(threading.local):
+def _user_row_factory(cursor, row):
+    return MobileUser(row[0], row[1])
+
+
+class DatabaseSQLBase:
     _args: dict
 
     def __init__(self):
         self._db = None
+        self._cursor = None
         self._module = None
 
+        # Statements are formatted once, rather than on every query
+        self._sql_insert_user = self._format("""
+            INSERT INTO relay_users(token, number) VALUES(?, ?)
+        """)
+        self._sql_update_timestamp = self._format("""
+            UPDATE relay_users SET last_seen = CURRENT_TIMESTAMP
+            WHERE token = ? AND number = ?
+        """)
+        self._sql_lookup_token = self._format("""
+            SELECT token, number FROM relay_users WHERE token = ?
+        """)
+        self._sql_lookup_number = self._format("""
+            SELECT token, number FROM relay_users WHERE number = ?
+        """)
+
     def __repr__(self):
         return self._module.__name__
 
@@ -39,56 +60,81 @@ class DatabaseSQLBase(threading.local):
         self.close()
 
     def create(self):
-        with contextlib.closing(self._db.cursor()) as c:
-            c.execute("""
-                CREATE TABLE IF NOT EXISTS relay_users (
-                    token      BINARY(16) NOT NULL UNIQUE,
-                    number     TEXT NOT NULL UNIQUE,
-                    last_seen  TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    registered INT
-                )
-            """)
+        self._execute("""
+            CREATE TABLE IF NOT EXISTS relay_users (
+                token      BINARY(16) NOT NULL UNIQUE,
+                number     TEXT NOT NULL UNIQUE,
+                last_seen  TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                registered INT
+            )
+        """)
 
     def connect(self):
         if self._db is None:
             self._db = self._module.connect(**self._args)
+            self._cursor = self._db.cursor()
 
     def close(self):
+        self._cursor.close()
+        self._cursor = None
         self._db.close()
         self._db = None
 
+    def _execute(self, sql, args=()):
+        # A single cursor is reused for every query on the connection
+        self._cursor.execute(sql, args)
+        return self._cursor
+
+    def _executemany(self, sql, rows):
+        self._cursor.executemany(sql, rows)
+
+    def shutdown(self):
+        # Close the connection for good, if it's still open
+        if self._db is not None:
+            self.close()
+
     def commit(self, *args, **kwargs):
         return self._db.commit(*args, **kwargs)
 
+    def rollback(self, *args, **kwargs):
+        return self._db.rollback(*args, **kwargs)
+
+    @property
+    def IntegrityError(self):
+        return self._module.IntegrityError
+
     def insert_user(self, token, number):
-        with contextlib.closing(self._db.cursor()) as c:
-            c.execute(self._format("""
-                INSERT INTO relay_users(token, number) VALUES(?, ?)
-            """), (token, number))
+        self._execute(self._sql_insert_user, (token, number))
+
+    def insert_users(self, rows):
+        self._executemany(self._sql_insert_user, rows)
 
     def update_timestamp(self, token, number):
-        with contextlib.closing(self._db.cursor()) as c:
-            c.execute(self._format("""
-                UPDATE relay_users SET last_seen = CURRENT_TIMESTAMP
-                WHERE token = ? AND number = ?
-            """), (token, number))
+        self._execute(self._sql_update_timestamp, (token, number))
+
+    def update_timestamps(self, rows):
+        self._executemany(self._sql_update_timestamp, rows)
+
+    def _lookup_user(self, sql, args):
+        row = self._execute(sql, args).fetchone()
+        if not row:
+            return None
+        return MobileUser(row[0], row[1])
 
     def lookup_token(self, token):
-        with contextlib.closing(self._db.cursor()) as c:
-            c.execute(self._format("""
-                SELECT token, number FROM relay_users WHERE token = ?
-            """), (token,))
-            return c.fetchone()
+        return self._lookup_user(self._sql_lookup_token, (token,))
 
     def lookup_number(self, number):
-        with contextlib.closing(self._db.cursor()) as c:
-            c.execute(self._format("""
-                SELECT token, number FROM relay_users WHERE number = ?
-            """), (number,))
-            return c.fetchone()
+        return self._lookup_user(self._sql_lookup_number, (number,))
 
+    def all_numbers(self):
+        # Fetch all rows at once, and build the set without a Python loop
+        rows = self._execute("SELECT number FROM relay_users").fetchall()
+        return set(map(operator.itemgetter(0), rows))
 
-class DatabaseMySQL(DatabaseSQLBase):
+
+class DatabaseMySQL(threading.local, DatabaseSQLBase):
+    # MySQLdb connections can't be shared, so each thread gets its own
     def __init__(self, **kwargs):
         if isinstance(MySQLdb, ImportError):
             raise MySQLdb
@@ -102,15 +148,90 @@ class DatabaseMySQL(DatabaseSQLBase):
 
 
 class DatabaseSQLite(DatabaseSQLBase):
-    def __init__(self, **kwargs):
+    _pragmas: dict
+    _connect_lock: threading.Lock
+
+    def __init__(self, journal_mode="wal", synchronous="normal", **kwargs):
         super().__init__()
         self._module = sqlite3
+
+        # A single connection is shared by every thread, see close()
         self._args = kwargs
+        self._args["check_same_thread"] = False
+        self._connect_lock = threading.Lock()
+
+        # WAL only needs to sync on checkpoints, instead of on every commit
+        self._pragmas = {
+            "journal_mode": journal_mode,
+            "synchronous": synchronous,
+        }
+
+    def connect(self):
+        if self._db is not None:
+            return
+        with self._connect_lock:
+            if self._db is not None:
+                return
+            db = self._module.connect(**self._args)
+            for name, value in self._pragmas.items():
+                db.execute("PRAGMA %s = %s" % (name, value))
+            self._db = db
+
+    def close(self):
+        # Other threads may still be using the connection, keep it open
+        pass
+
+    def shutdown(self):
+        with self._connect_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _execute(self, sql, args=()):
+        # A shared cursor would mix up results between threads, instead let
+        #  the connection create a temporary one for each query.
+        return self._db.execute(sql, args)
+
+    def _executemany(self, sql, rows):
+        self._db.executemany(sql, rows)
+
+    def create(self):
+        # Rows are stored in the token's index, and the number's index holds
+        #  the token as well, so lookups never need a second table access.
+        self._execute("""
+            CREATE TABLE IF NOT EXISTS relay_users (
+                token      BINARY(16) NOT NULL PRIMARY KEY,
+                number     TEXT NOT NULL UNIQUE,
+                last_seen  TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                registered INT
+            ) WITHOUT ROWID
+        """)
+
+    def _lookup_user(self, sql, args):
+        # Have sqlite3 build the user while fetching the row
+        c = self._db.cursor()
+        c.row_factory = _user_row_factory
+        return c.execute(sql, args).fetchone()
 
 
 class MobileUserDatabase:
     _db: typing.Union[DatabaseMySQL, DatabaseSQLite]
-    _new_write_lock: threading.Lock
+    _write_lock: threading.Lock
+    _by_token: dict[bytes, MobileUser]
+    _numbers: set[str]
+    _pending_updates: dict[bytes, MobileUser]
+    _pending_lock: threading.Lock
+    _updater: threading.Thread
+    _updater_stop: threading.Event
+    _random_pool: bytes
+    _random_offset: int
+    _random_lock: threading.Lock
+
+    # Bytes of randomness read at once by _random_bytes()
+    RANDOM_POOL_SIZE = 4096
+
+    # Seconds between writes of batched last_seen updates
+    UPDATE_INTERVAL = 5
 
     def __init__(self, filename):
         dbconfig = configparser.ConfigParser()
@@ -124,7 +245,32 @@ class MobileUserDatabase:
         print("Database:", self._db)
 
         self._db.init()
-        self._new_write_lock = threading.Lock()
+
+        # Transactions may share a connection with other threads, so only
+        #  one thread may write and commit at a time.
+        self._write_lock = threading.Lock()
+
+        self._random_pool = b""
+        self._random_offset = 0
+        self._random_lock = threading.Lock()
+
+        # Users are never modified or removed, so cached entries can't go
+        #  stale. Misses aren't cached, as the user may be created later.
+        self._by_token = {}
+
+        # Every number in use, to avoid querying for each generated number.
+        # The database still rejects numbers taken by other servers using it.
+        with self:
+            self._numbers = self._db.all_numbers()
+
+        # Timestamp updates are written in batches by a background thread
+        self._pending_updates = {}
+        self._pending_lock = threading.Lock()
+        self._updater_stop = threading.Event()
+        self._updater = threading.Thread(target=self._update_thread,
+                                         daemon=True)
+        self._updater.start()
+        atexit.register(self.flush)
 
     def __enter__(self):
         self.connect()
@@ -135,51 +281,148 @@ class MobileUserDatabase:
     def connect(self) -> None:
         self._db.connect()
 
+    def shutdown(self) -> None:
+        # Stop the background thread, write what's left and disconnect
+        self._updater_stop.set()
+        self._updater.join()
+        atexit.unregister(self.flush)
+        self.flush()
+        self._db.shutdown()
+
     def close(self) -> None:
         self._db.close()
 
-    def _generate_token(self) -> typing.Optional[bytes]:
+    def _random_bytes(self, size: int) -> bytes:
+        # Hand out slices of a larger read from the system's CSPRNG, so
+        #  generating a batch of users doesn't need a syscall per value.
+        with self._random_lock:
+            offset = self._random_offset
+            if offset + size > len(self._random_pool):
+                self._random_pool = os.urandom(self.RANDOM_POOL_SIZE)
+                offset = 0
+            self._random_offset = offset + size
+            return self._random_pool[offset:offset + size]
+
+    def _generate_token(self, taken: typing.Container[bytes] = ()
+                        ) -> typing.Optional[bytes]:
+        # Collisions with existing users are practically impossible, so the
+        #  database isn't queried. Its UNIQUE constraint catches them anyway.
         for x in range(10):
-            token = secrets.token_bytes(16)
-            if self.lookup_token(token):
+            token = self._random_bytes(16)
+            if token in taken:
                 continue
             return token
         return None
 
-    def _generate_number(self) -> typing.Optional[str]:
+    def _generate_number(self, taken: typing.Container[str] = ()
+                         ) -> typing.Optional[str]:
+        # Numbers starting with "00" or "010" aren't handed out, so only
+        #  draw from 0110000000 onwards, which are always 10 digits long.
         for x in range(10):
-            number = "0" + "%09d" % secrets.randbelow(1000000000)
-            if number.startswith("00"):
-                continue
-            if number.startswith("010"):
+            # 64 random bits make the modulo bias negligible
+            value = int.from_bytes(self._random_bytes(8), "little")
+            number = f"0{value % 890000000 + 110000000}"
+            if number in taken:
                 continue
-            if self.lookup_number(number):
+            if number in self._numbers:
                 continue
             return number
         return None
 
     def new(self) -> typing.Optional[MobileUser]:
-        with self._new_write_lock:
-            token = self._generate_token()
-            number = self._generate_number()
+        users = self.new_batch(1)
+        if not users:
+            return None
+        return users[0]
+
+    def new_batch(self, count: int) -> list[MobileUser]:
+        # Create up to count users, inserted and committed all at once
+        # Generated values may race with other threads, but the database
+        #  rejects any duplicates, in which case we retry with fresh values.
+        for x in range(3):
+            users = self._generate_users(count)
+            if not users:
+                return users
+            with self._write_lock:
+                if self._insert_users(users):
+                    break
+        else:
+            return []
+        for user in users:
+            self._by_token[user.token] = user
+        return users
+
+    def _generate_users(self, count: int) -> list[MobileUser]:
+        users: list[MobileUser] = []
+        tokens: set[bytes] = set()
+        numbers: set[str] = set()
+        for x in range(count):
+            token = self._generate_token(tokens)
+            number = self._generate_number(numbers)
             if not token or not number:
-                return None
-            self._db.insert_user(token, number)
+                break
+            tokens.add(token)
+            numbers.add(number)
+            users.append(MobileUser(token, number))
+        return users
+
+    def _insert_users(self, users: list[MobileUser]) -> bool:
+        try:
+            if len(users) == 1:
+                self._db.insert_user(users[0].token, users[0].number)
+            else:
+                self._db.insert_users([(x.token, x.number) for x in users])
             self._db.commit()
-        return MobileUser(token, number)
+        except self._db.IntegrityError:
+            self._db.rollback()
+            return False
+        except Exception:
+            # Don't leave the transaction open for the next commit
+            self._db.rollback()
+            raise
+        self._numbers.update(x.number for x in users)
+        return True
 
     def update(self, user: MobileUser) -> None:
-        self._db.update_timestamp(user.token, user.number)
-        self._db.commit()
+        with self._pending_lock:
+            self._pending_updates[user.token] = user
+
+    def _update_thread(self) -> None:
+        while not self._updater_stop.wait(self.UPDATE_INTERVAL):
+            self.flush()
+
+    def flush(self) -> None:
+        # Write all pending updates in a single transaction
+        with self._pending_lock:
+            if not self._pending_updates:
+                return
+            pending = self._pending_updates
+            self._pending_updates = {}
+        try:
+            with self, self._write_lock:
+                try:
+                    self._db.update_timestamps([(x.token, x.number)
+                                                for x in pending.values()])
+                    self._db.commit()
+                except Exception:
+                    # Don't leave the transaction open for the next commit
+                    self._db.rollback()
+                    raise
+        except Exception as e:
+            # Keep the batch around for the next attempt
+            print("Failed to update timestamps:", repr(e))
+            with self._pending_lock:
+                pending.update(self._pending_updates)
+                self._pending_updates = pending
 
     def lookup_token(self, token: bytes) -> typing.Optional[MobileUser]:
-        row = self._db.lookup_token(token)
-        if not row:
-            return None
-        return MobileUser(row[0], row[1])
+        user = self._by_token.get(token)
+        if user is not None:
+            return user
+        user = self._db.lookup_token(token)
+        if user is not None:
+            self._by_token[token] = user
+        return user
 
     def lookup_number(self, number: str) -> typing.Optional[MobileUser]:
-        row = self._db.lookup_number(number)
-        if not row:
-            return None
-        return MobileUser(row[0], row[1])
+        return self._db.lookup_number(number)